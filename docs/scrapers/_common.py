@@ -0,0 +1,67 @@
+"""
+Shared helpers for the scraper scripts in this directory.
+
+Keep this file next to the scripts; they import it as a sibling module.
+"""
+
+import json
+import os
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+try:
+    import ijson
+    HAS_IJSON = True
+except ImportError:
+    HAS_IJSON = False
+
+# Shared session: reuses TCP/TLS connections across requests to the same host
+SESSION = requests.Session()
+SESSION.headers['Connection'] = 'keep-alive'
+_adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=64,
+    max_retries=Retry(total=3, backoff_factor=0.2)
+)
+SESSION.mount('http://', _adapter)
+SESSION.mount('https://', _adapter)
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+def dump_json(obj) -> bytes:
+    """Serialize obj to UTF-8 JSON bytes (orjson when installed)."""
+    if HAS_ORJSON:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+def load_json(data):
+    """Deserialize JSON from str or bytes (orjson when installed)."""
+    if HAS_ORJSON:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def load_excluded_domains_json(filepath):
+    """Load excluded domains from a JSON file with detailed info."""
+    if not filepath or not os.path.exists(filepath):
+        return frozenset()
+    with open(filepath, 'rb') as f:
+        try:
+            # Stream entries with ijson when available instead of decoding the whole file
+            entries = ijson.items(f, 'item') if HAS_IJSON else load_json(f.read())
+            domains = (entry.get('domain') for entry in entries if isinstance(entry, dict))
+            return frozenset(d.strip().lower() for d in domains if isinstance(d, str) and d.strip())
+        except Exception as e:
+            print(f"Error loading exclusions JSON: {e}")
+            return frozenset()
+
+def is_excluded(domain, excluded_domains):
+    """Check whether domain or any of its parent domains is excluded."""
+    parts = domain.split('.')
+    return any('.'.join(parts[i:]) in excluded_domains for i in range(len(parts)))
@@ -4,27 +4,67 @@ Query Shoko Server for anime metadata and inject into knowledge base.
 Shoko provides enriched anime data with AniDB integration.
 """
 
-import xml.etree.ElementTree as ET
-import json
+import gzip
+import os
+import pickle
+import threading
 import uuid
-from datetime import datetime
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, List, Tuple, Optional
+from typing import Dict, Iterator, List, Tuple, Optional
 import requests
 
+from _common import SESSION, JSON_HEADERS, dump_json, load_json
+
+try:
+    from lxml import etree
+    HAS_LXML = True
+except ImportError:
+    import xml.etree.ElementTree as etree
+    HAS_LXML = False
+
+try:
+    import marisa_trie
+    HAS_MARISA = True
+except ImportError:
+    HAS_MARISA = False
+
+try:
+    import ahocorasick
+    HAS_AHOCORASICK = True
+except ImportError:
+    HAS_AHOCORASICK = False
+
+XML_LANG_ATTR = '{http://www.w3.org/XML/1998/namespace}lang'
+# Bump when the lookup layout changes so stale parse caches are rebuilt
+LOOKUP_VERSION = 3
+
 # Shoko Server configuration
 SHOKO_HOST = "your-shoko-server.local"  # e.g., "192.168.1.21"
 SHOKO_PORT = 8112
 SHOKO_BASE_URL = f"http://{SHOKO_HOST}:{SHOKO_PORT}/api/v3"
 
-# Fallback to XML if Shoko is unavailable
+# Fallback to XML if Shoko is unavailable; the prebuilt index is preferred when present
 XML_FILE = Path(__file__).parent.parent / "anime-titles.xml"
+INDEX_FILE = XML_FILE.with_name("anime-titles.jsonl.gz")  # see build_anime_index.py
 WEBHOOK_URL = "http://your-n8n-instance/webhook/teachhanna"  # Your n8n TeachHanna webhook
 
+# Concurrent webhook posts during injection (override via environment)
+INJECT_WORKERS = int(os.environ.get("HANNA_INJECT_WORKERS", "16"))
+INJECT_MAX_IN_FLIGHT = int(os.environ.get("HANNA_INJECT_MAX_IN_FLIGHT", "64"))
+# Facts per webhook POST. The default of 1 sends the plain single-fact payload the
+# shipped TeachHanna workflow expects; larger values need the batch-aware
+# workflow described in docs/WORKFLOWS.md ("Batched Requests")
+INJECT_BATCH_SIZE = int(os.environ.get("HANNA_INJECT_BATCH_SIZE", "1"))
+ANIDB_TAGS = ["anime", "anidb", "metadata"]
+
 def check_shoko_health() -> bool:
     """Check if Shoko Server is available."""
     try:
-        response = requests.get(f"{SHOKO_BASE_URL}/series", timeout=3)
+        response = SESSION.get(f"{SHOKO_BASE_URL}/series", timeout=3)
         return response.status_code == 200
     except:
         return False
@@ -32,19 +72,21 @@ def check_shoko_health() -> bool:
 def search_shoko(query: str) -> Optional[Dict]:
     """
     Query Shoko Server for anime.
-    Returns enriched anime data with AniDB links.
+    Returns enriched anime data with AniDB links, or None if Shoko is
+    unreachable or has no match.
     """
-    if not check_shoko_health():
-        return None
-    
     try:
         # Search Shoko for anime matching query
-        response = requests.get(
+        response = SESSION.get(
             f"{SHOKO_BASE_URL}/search",
             params={"query": query, "limit": 1},
             timeout=5
         )
-        
+    except requests.RequestException:
+        # Shoko unreachable: the search request doubles as the health check
+        return None
+    
+    try:
         if response.status_code != 200:
             return None
         
@@ -72,53 +114,111 @@ def search_shoko(query: str) -> Optional[Dict]:
         print(f"⚠️  Shoko search error: {e}")
         return None
 
-def parse_anime_titles(xml_path: Path) -> Dict:
+def anidb_url(aid: int) -> str:
+    """Return the AniDB page URL for an anime id."""
+    return f"https://anidb.net/?aid={aid}"
+
+def iter_anime_xml(xml_path: Path) -> Iterator[Tuple[int, List[Tuple[str, str, str]]]]:
+    """
+    Stream (aid, [(text, type, lang), ...]) records from anime-titles.xml.
+    Elements without an aid and titles without text are skipped.
     """
-    Parse anime-titles.xml and build a lookup dictionary.
+    # Stream <anime> elements instead of building the whole DOM up front
+    if HAS_LXML:
+        context = etree.iterparse(str(xml_path), events=('end',), tag='anime')
+    else:
+        context = (
+            (event, elem) for event, elem in etree.iterparse(str(xml_path), events=('end',))
+            if elem.tag == 'anime'
+        )
+    
+    for _, anime_elem in context:
+        aid = anime_elem.get('aid')
+        if aid:
+            titles = []
+            for title_elem in anime_elem:
+                if title_elem.tag != 'title' or not title_elem.text:
+                    continue
+                titles.append((
+                    title_elem.text,
+                    title_elem.get('type', 'unknown'),
+                    title_elem.get(XML_LANG_ATTR, 'unknown')
+                ))
+            yield int(aid), titles
+        
+        # Free the processed element (and, with lxml, its already-seen siblings)
+        anime_elem.clear()
+        if HAS_LXML:
+            while anime_elem.getprevious() is not None:
+                del anime_elem.getparent()[0]
+
+def iter_anime_index(index_path: Path) -> Iterator[Tuple[int, List[List[str]]]]:
+    """
+    Stream (aid, [[text, type, lang], ...]) records from a gzipped JSONL
+    index written by build_anime_index.py.
+    """
+    with gzip.open(index_path, 'rb') as f:
+        for line in f:
+            record = load_json(line)
+            yield record['aid'], record['titles']
+
+def parse_anime_titles(titles_path: Path) -> Dict:
+    """
+    Parse anime-titles.xml (or its prebuilt anime-titles.jsonl.gz index)
+    and build a lookup dictionary. The result is cached next to the source
+    file (.pkl) and reused until the source is newer than the cache.
     
     Returns dict: {
         'abbreviations': {'jjk': 6594, 'op': 21, ...},
         'titles': {'Jujutsu Kaisen': 6594, ...},
-        'anime_data': {6594: {'titles': [...], 'aid': 6594}, ...}
+        'main_titles': {6594: 'Jujutsu Kaisen', ...},
+        'titles_strs': {6594: 'Jujutsu Kaisen, JJK, ...', ...},
+        'related_entities': {6594: ['Jujutsu Kaisen', 'JJK', ...], ...}
     }
+    
+    Per-anime fields are kept in parallel dicts keyed by aid rather than one
+    dict per anime, and only the fields search and injection read are kept
+    (title types and languages are dropped after parsing); use anidb_url(aid)
+    for the AniDB link.
     """
-    if not xml_path.exists():
-        print(f"❌ File not found: {xml_path}")
+    if not titles_path.exists():
+        print(f"❌ File not found: {titles_path}")
         return {}
     
-    print(f"📖 Parsing {xml_path}...")
+    cache_path = titles_path.with_suffix('.pkl')
+    if cache_path.exists() and cache_path.stat().st_mtime >= titles_path.stat().st_mtime:
+        try:
+            with open(cache_path, 'rb') as f:
+                lookup = pickle.load(f)
+            if lookup.get('version') == LOOKUP_VERSION:
+                print(f"✅ Loaded {len(lookup['main_titles'])} anime from cache {cache_path}")
+                return lookup
+            print(f"⚠️  Ignoring outdated cache {cache_path}")
+        except Exception as e:
+            print(f"⚠️  Ignoring unreadable cache {cache_path}: {e}")
     
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
+    print(f"📖 Parsing {titles_path}...")
     
     lookup = {
+        'version': LOOKUP_VERSION,
         'abbreviations': {},
         'titles': {},
-        'anime_data': {}
+        'main_titles': {},
+        'titles_strs': {},
+        'related_entities': {}
     }
     
-    for anime_elem in root.findall('anime'):
-        aid = anime_elem.get('aid')
-        if not aid:
-            continue
-        
-        aid = int(aid)
-        titles_list = []
+    if titles_path.name.endswith('.jsonl.gz'):
+        records = iter_anime_index(titles_path)
+    else:
+        records = iter_anime_xml(titles_path)
+    
+    for aid, titles in records:
+        title_texts = []
         main_title = None
         
-        for title_elem in anime_elem.findall('title'):
-            title_text = title_elem.text
-            title_type = title_elem.get('type', 'unknown')
-            lang = title_elem.get('{http://www.w3.org/XML/1998/namespace}lang', 'unknown')
-            
-            if not title_text:
-                continue
-            
-            titles_list.append({
-                'text': title_text,
-                'type': title_type,
-                'lang': lang
-            })
+        for title_text, title_type, lang in titles:
+            title_texts.append(title_text)
             
             # Store main title (usually the first one or type='main')
             if title_type == 'main' or main_title is None:
@@ -132,99 +232,264 @@ def parse_anime_titles(xml_path: Path) -> Dict:
                 lookup['abbreviations'][title_text.lower()] = aid
         
         # Store anime data
-        lookup['anime_data'][aid] = {
-            'aid': aid,
-            'main_title': main_title,
-            'titles': titles_list,
-            'anidb_url': f"https://anidb.net/?aid={aid}"
-        }
+        lookup['main_titles'][aid] = main_title
+        # Prebuilt payload fields for inject_to_knowledge_base
+        lookup['titles_strs'][aid] = ", ".join(title_texts)
+        lookup['related_entities'][aid] = title_texts[:5]
     
-    print(f"✅ Loaded {len(lookup['anime_data'])} anime")
+    build_title_index(lookup)
+    
+    print(f"✅ Loaded {len(lookup['main_titles'])} anime")
     print(f"   - {len(lookup['abbreviations'])} abbreviations")
     print(f"   - {len(lookup['titles'])} total titles")
     
+    try:
+        with open(cache_path, 'wb') as f:
+            pickle.dump(lookup, f, protocol=5)
+    except OSError as e:
+        print(f"⚠️  Could not write cache {cache_path}: {e}")
+    
     return lookup
 
+def build_title_index(lookup: Dict) -> None:
+    """
+    Build the prefix and substring indexes used by search_anime.
+    
+    Adds to lookup:
+        'title_keys': sorted list of lowercased titles
+        'title_trie': marisa_trie.Trie over title_keys (None without marisa-trie)
+        'trigram_index': {'jut': [0, 17, ...], ...} -> indices into title_keys
+    """
+    title_keys = sorted(lookup['titles'])
+    trigram_index = {}
+    
+    for idx, title in enumerate(title_keys):
+        for trigram in {title[i:i + 3] for i in range(len(title) - 2)}:
+            trigram_index.setdefault(trigram, []).append(idx)
+    
+    lookup['title_keys'] = title_keys
+    lookup['title_trie'] = marisa_trie.Trie(title_keys) if HAS_MARISA else None
+    lookup['trigram_index'] = trigram_index
+
+def _prefix_matches(lookup: Dict, prefix: str) -> List[str]:
+    """Return all lowercased titles starting with prefix."""
+    if lookup.get('title_trie') is not None:
+        return lookup['title_trie'].keys(prefix)
+    
+    # Sorted-list fallback: titles sharing a prefix are contiguous
+    title_keys = lookup['title_keys']
+    matches = []
+    for title in title_keys[bisect_left(title_keys, prefix):]:
+        if not title.startswith(prefix):
+            break
+        matches.append(title)
+    return matches
+
+def _substring_matches(lookup: Dict, query: str) -> List[str]:
+    """Return all lowercased titles containing query."""
+    if len(query) < 3:
+        # Too short for the trigram index; scan
+        return [title for title in lookup['title_keys'] if query in title]
+    
+    postings = []
+    for i in range(len(query) - 2):
+        indices = lookup['trigram_index'].get(query[i:i + 3])
+        if indices is None:
+            return []
+        postings.append(indices)
+    
+    postings.sort(key=len)
+    candidates = set(postings[0])
+    for indices in postings[1:]:
+        candidates.intersection_update(indices)
+        if not candidates:
+            return []
+    
+    # Trigram hits are only candidates; verify the full query is present
+    title_keys = lookup['title_keys']
+    return [title_keys[idx] for idx in sorted(candidates) if query in title_keys[idx]]
+
+def _abbreviation_automaton(lookup: Dict):
+    """
+    Return an Aho-Corasick automaton over all abbreviations, building it
+    on first use. Returns None without pyahocorasick.
+    """
+    if not HAS_AHOCORASICK or not lookup['abbreviations']:
+        return None
+    if lookup.get('abbr_automaton') is None:
+        automaton = ahocorasick.Automaton()
+        for abbr in lookup['abbreviations']:
+            automaton.add_word(abbr, abbr)
+        automaton.make_automaton()
+        lookup['abbr_automaton'] = automaton
+    return lookup['abbr_automaton']
+
+def _abbreviations_in(lookup: Dict, query: str) -> List[str]:
+    """Return abbreviations contained in query (e.g. 'jjk' in 'jjk season 2')."""
+    automaton = _abbreviation_automaton(lookup)
+    if automaton is None:
+        return [abbr for abbr in lookup['abbreviations'] if abbr in query]
+    # One pass over the query finds every abbreviation inside it
+    return [abbr for _, abbr in automaton.iter(query)]
+
+def _partial_match_aids(lookup: Dict, query: str):
+    """
+    Yield aids of partial matches, best first: abbreviations inside the
+    query, then titles starting with it, then titles containing it.
+    Abbreviations are also titles, so the title passes cover abbreviations
+    that contain the query. Later passes only run if the caller keeps going.
+    """
+    for abbr in _abbreviations_in(lookup, query):
+        yield lookup['abbreviations'][abbr]
+    for title in _prefix_matches(lookup, query):
+        yield lookup['titles'][title]
+    for title in _substring_matches(lookup, query):
+        yield lookup['titles'][title]
+
+# Lookup that _search_cached results belong to; swapped (and the cache
+# cleared) whenever search_anime is called with a different lookup
+_search_lookup: Optional[Dict] = None
+
 def search_anime(lookup: Dict, query: str) -> List[Tuple[int, str, str]]:
     """
     Search for anime by abbreviation or title.
     Returns list of (aid, main_title, anidb_url) tuples.
+    Results are memoized per lowercased query for the current lookup.
     """
-    query_lower = query.lower()
+    global _search_lookup
+    if lookup is not _search_lookup:
+        _search_lookup = lookup
+        _search_cached.cache_clear()
+    return list(_search_cached(query.lower()))
+
+@lru_cache(maxsize=2048)
+def _search_cached(query_lower: str) -> Tuple[Tuple[int, str, str], ...]:
+    return tuple(_search_anime(_search_lookup, query_lower))
+
+def _search_anime(lookup: Dict, query_lower: str) -> List[Tuple[int, str, str]]:
+    """Uncached search_anime; query_lower must already be lowercased."""
     results = []
     
     # Exact abbreviation match (highest priority)
     if query_lower in lookup['abbreviations']:
         aid = lookup['abbreviations'][query_lower]
-        anime = lookup['anime_data'][aid]
-        return [(aid, anime['main_title'], anime['anidb_url'])]
+        return [(aid, lookup['main_titles'][aid], anidb_url(aid))]
     
     # Exact title match
     if query_lower in lookup['titles']:
         aid = lookup['titles'][query_lower]
-        anime = lookup['anime_data'][aid]
-        return [(aid, anime['main_title'], anime['anidb_url'])]
-    
-    # Partial match in abbreviations
-    for abbr, aid in lookup['abbreviations'].items():
-        if query_lower in abbr or abbr in query_lower:
-            anime = lookup['anime_data'][aid]
-            results.append((aid, anime['main_title'], anime['anidb_url']))
-    
-    # Partial match in titles
-    for title, aid in lookup['titles'].items():
-        if query_lower in title and (aid, title, lookup['anime_data'][aid]['anidb_url']) not in results:
-            anime = lookup['anime_data'][aid]
-            results.append((aid, anime['main_title'], anime['anidb_url']))
-    
-    return results[:10]  # Return top 10 matches
+        return [(aid, lookup['main_titles'][aid], anidb_url(aid))]
+    
+    # Partial matches, deduplicated by aid
+    seen_aids = set()
+    for aid in _partial_match_aids(lookup, query_lower):
+        if aid in seen_aids:
+            continue
+        seen_aids.add(aid)
+        results.append((aid, lookup['main_titles'][aid], anidb_url(aid)))
+        if len(results) >= 10:  # Return top 10 matches
+            break
+    
+    return results
 
 def inject_to_knowledge_base(lookup: Dict) -> None:
     """
     Inject anime metadata into TeachHanna webhook for Qdrant storage.
+    Facts are posted concurrently from a bounded worker pool, one per request
+    unless INJECT_BATCH_SIZE > 1 groups them into gzipped {"items": [...]} batches.
     """
     print(f"📤 Injecting anime metadata to knowledge base...")
     
-    success_count = 0
-    error_count = 0
-    total = len(lookup['anime_data'])
+    counts = {'success': 0, 'error': 0}
+    counts_lock = threading.Lock()
+    # Caps queued + running posts so the executor queue can't grow unbounded
+    in_flight = threading.BoundedSemaphore(INJECT_MAX_IN_FLIGHT)
+    total = len(lookup['main_titles'])
     
-    for idx, (aid, anime_data) in enumerate(lookup['anime_data'].items(), 1):
-        if idx % 500 == 0:
-            print(f"   [{idx}/{total}] {success_count} success, {error_count} errors...")
-        titles_str = ", ".join([t['text'] for t in anime_data['titles']])
-        
-        payload = {
-            "id": str(uuid.uuid4()),
-            "text": f"{anime_data['main_title']} - {titles_str}",
-            "url": anime_data['anidb_url'],
-            "title": anime_data['main_title'],
-            "source_type": "anidb_metadata",
-            "confidence": 0.95,
-            "timestamp": datetime.utcnow().isoformat() + "Z",
-            "sourceUser": None,
-            "tags": ["anime", "anidb", "metadata"],
-            "related_entities": [t['text'] for t in anime_data['titles'][:5]]
-        }
-        
+    def _post(batch: List[Dict]) -> int:
+        if INJECT_BATCH_SIZE <= 1:
+            return SESSION.post(WEBHOOK_URL, data=dump_json(batch[0]), headers=JSON_HEADERS, timeout=5).status_code
+        body = gzip.compress(dump_json({'items': batch}))
+        headers = {**JSON_HEADERS, 'Content-Encoding': 'gzip'}
+        return SESSION.post(WEBHOOK_URL, data=body, headers=headers, timeout=30).status_code
+    
+    def _on_complete(future, batch_size: int, label: str) -> None:
         try:
-            response = requests.post(WEBHOOK_URL, json=payload, timeout=5)
-            if response.status_code in [200, 201]:
-                success_count += 1
-            else:
-                error_count += 1
-                print(f"⚠️  HTTP {response.status_code} for {anime_data['main_title']}")
+            status_code = future.result()
+            with counts_lock:
+                if status_code in [200, 201]:
+                    counts['success'] += batch_size
+                else:
+                    counts['error'] += batch_size
+            if status_code not in [200, 201]:
+                print(f"⚠️  HTTP {status_code} for {label}")
         except Exception as e:
-            error_count += 1
-            print(f"❌ Error for {anime_data['main_title']}: {e}")
+            with counts_lock:
+                counts['error'] += batch_size
+            print(f"❌ Error for {label}: {e}")
+        finally:
+            in_flight.release()
+    
+    def _submit(executor: ThreadPoolExecutor, batch: List[Dict]) -> None:
+        if len(batch) == 1:
+            label = batch[0]['title']
+        else:
+            label = f"batch of {len(batch)} starting at {batch[0]['title']}"
+        in_flight.acquire()
+        future = executor.submit(_post, batch)
+        future.add_done_callback(
+            lambda f, batch_size=len(batch), label=label: _on_complete(f, batch_size, label)
+        )
+    
+    batch = []
+    # All records in one injection run share the same ingest timestamp
+    now_iso = datetime.now(timezone.utc).isoformat(timespec='seconds').replace('+00:00', 'Z')
+    with ThreadPoolExecutor(max_workers=INJECT_WORKERS) as executor:
+        for idx, (aid, main_title) in enumerate(lookup['main_titles'].items(), 1):
+            if idx % 500 == 0:
+                with counts_lock:
+                    print(f"   [{idx}/{total}] {counts['success']} success, {counts['error']} errors...")
+            
+            batch.append({
+                "id": str(uuid.uuid4()),
+                "text": f"{main_title} - {lookup['titles_strs'][aid]}",
+                "url": anidb_url(aid),
+                "title": main_title,
+                "source_type": "anidb_metadata",
+                "confidence": 0.95,
+                "timestamp": now_iso,
+                "sourceUser": None,
+                "tags": ANIDB_TAGS,
+                "related_entities": lookup['related_entities'][aid]
+            })
+            
+            if len(batch) >= INJECT_BATCH_SIZE:
+                _submit(executor, batch)
+                batch = []
+        
+        if batch:
+            _submit(executor, batch)
     
-    print(f"✅ Injection complete: {success_count} success, {error_count} errors")
+    print(f"✅ Injection complete: {counts['success']} success, {counts['error']} errors")
+
+def titles_source() -> Path:
+    """
+    Pick the file to load titles from: the prebuilt index unless it is
+    missing or older than anime-titles.xml.
+    """
+    if not INDEX_FILE.exists():
+        return XML_FILE
+    if XML_FILE.exists() and INDEX_FILE.stat().st_mtime < XML_FILE.stat().st_mtime:
+        print(f"⚠️  {INDEX_FILE.name} is older than {XML_FILE.name}; parsing the XML instead "
+              f"(rerun build_anime_index.py to refresh it)")
+        return XML_FILE
+    return INDEX_FILE
 
 def main():
     import sys
     
     # Load lookup
-    lookup = parse_anime_titles(XML_FILE)
+    lookup = parse_anime_titles(titles_source())
     if not lookup:
         return
     
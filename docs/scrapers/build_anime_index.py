@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Build a compact anime-titles.jsonl.gz index from AniDB's anime-titles.xml.
+
+Each line is one anime with only the fields anime_lookup.py uses:
+
+  {"aid": 6594, "titles": [["Jujutsu Kaisen", "main", "x-jat"], ["JJK", "short", "en"], ...]}
+
+When the index exists, anime_lookup.py loads it instead of the XML, so no
+XML parser is needed at runtime. The XML stays the source of truth: rerun
+this script whenever you download a new anime-titles.xml.
+
+Run:
+  python build_anime_index.py [anime-titles.xml] [anime-titles.jsonl.gz]
+"""
+
+import gzip
+import sys
+from pathlib import Path
+
+from anime_lookup import INDEX_FILE, XML_FILE, dump_json, iter_anime_xml
+
+def build_anime_index(xml_path: Path, index_path: Path) -> int:
+    """Stream xml_path into a gzipped JSONL index. Returns the anime count."""
+    count = 0
+    with gzip.open(index_path, 'wb') as f:
+        for aid, titles in iter_anime_xml(xml_path):
+            f.write(dump_json({'aid': aid, 'titles': titles}))
+            f.write(b'\n')
+            count += 1
+    return count
+
+def main():
+    xml_path = Path(sys.argv[1]) if len(sys.argv) > 1 else XML_FILE
+    index_path = Path(sys.argv[2]) if len(sys.argv) > 2 else INDEX_FILE
+
+    if not xml_path.exists():
+        print(f"❌ File not found: {xml_path}")
+        sys.exit(1)
+
+    print(f"📖 Indexing {xml_path}...")
+    count = build_anime_index(xml_path, index_path)
+    print(f"✅ Wrote {count} anime to {index_path}")
+
+if __name__ == "__main__":
+    main()
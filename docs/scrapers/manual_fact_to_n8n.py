@@ -1,8 +1,9 @@
-import requests
 import uuid
 import os
-import json
-from datetime import datetime
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+from _common import SESSION, JSON_HEADERS, dump_json, is_excluded, load_excluded_domains_json
 
 """
 Manual Fact Entry Template - Schema Reference
@@ -39,18 +40,6 @@ Run:
   python manual_fact_to_n8n.py
 """
 
-def load_excluded_domains_json(filepath):
-    """Load excluded domains from a JSON file with detailed info."""
-    if not filepath or not os.path.exists(filepath):
-        return set()
-    with open(filepath, 'r', encoding='utf-8') as f:
-        try:
-            data = json.load(f)
-            return set(entry['domain'].strip().lower() for entry in data if 'domain' in entry)
-        except Exception as e:
-            print(f"Error loading exclusions JSON: {e}")
-            return set()
-
 def manual_fact_entry_and_send(webhook_url, ca_cert_path=None, excluded_domains_path=None):
     """
     Prompt user to manually enter facts and send them to an n8n webhook for embedding and vector storage.
@@ -59,12 +48,16 @@ def manual_fact_entry_and_send(webhook_url, ca_cert_path=None, excluded_domains_
         ca_cert_path (str): Path to CA certificate for SSL verification.
         excluded_domains_path (str): Path to exclusions list (JSON).
     """
-    excluded_domains = load_excluded_domains_json(excluded_domains_path) if excluded_domains_path else set()
+    excluded_domains = load_excluded_domains_json(excluded_domains_path) if excluded_domains_path else frozenset()
     while True:
         url = input("Source URL (or leave blank): ").strip()
         if url:
-            domain = url.split('/')[2].lower() if '://' in url else url.lower()
-            if any(domain == ex or domain.endswith('.' + ex) for ex in excluded_domains):
+            try:
+                domain = (urlsplit(url).hostname or url).lower()
+            except ValueError as e:
+                print(f"Invalid URL ({e}), please try again.")
+                continue
+            if is_excluded(domain, excluded_domains):
                 print(f"Skipping excluded domain: {domain}")
                 continue
         title = input("Title (optional): ").strip()
@@ -90,7 +83,7 @@ def manual_fact_entry_and_send(webhook_url, ca_cert_path=None, excluded_domains_
             "title": title if title else None,
             "source_type": source_type,
             "confidence": confidence,
-            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec='seconds').replace('+00:00', 'Z'),
             "sourceUser": None,
             "tags": tag_list,
             "related_entities": related_list
@@ -98,7 +91,7 @@ def manual_fact_entry_and_send(webhook_url, ca_cert_path=None, excluded_domains_
         try:
             verify = ca_cert_path if ca_cert_path else True
             print(f"Sending payload to n8n webhook: {webhook_url}")
-            r = requests.post(webhook_url, json=payload, timeout=10, verify=verify)
+            r = SESSION.post(webhook_url, data=dump_json(payload), headers=JSON_HEADERS, timeout=10, verify=verify)
             print(f"Status: {r.status_code}")
             print(f"Response: {r.text}")
         except Exception as e:
@@ -1,10 +1,16 @@
-import requests
 import uuid
 from bs4 import BeautifulSoup
-from urllib.parse import urlparse
-from datetime import datetime
+from urllib.parse import urlsplit
+from datetime import datetime, timezone
 import os
-import json
+import threading
+from importlib.util import find_spec
+from concurrent.futures import ThreadPoolExecutor
+
+from _common import SESSION, JSON_HEADERS, dump_json, is_excluded, load_excluded_domains_json
+
+# libxml2-backed lxml is much faster than html.parser when installed
+HTML_PARSER = "lxml" if find_spec("lxml") is not None else "html.parser"
 
 """
 Web Scraper Template - Schema Reference
@@ -33,18 +39,26 @@ Run:
 Respects excluded_domains.json for ethical scraping.
 """
 
-def load_excluded_domains_json(filepath):
-    """Load excluded domains from a JSON file with detailed info."""
-    if not os.path.exists(filepath):
-        return set()
-    with open(filepath, 'r', encoding='utf-8') as f:
-        try:
-            data = json.load(f)
-            return set(entry['domain'].strip().lower() for entry in data if 'domain' in entry)
-        except Exception as e:
-            print(f"Error loading exclusions JSON: {e}")
-            return set()
+# Concurrent page fetches, and at most SCRAPE_PER_HOST at once to any one host
+SCRAPE_WORKERS = int(os.environ.get("HANNA_SCRAPE_WORKERS", "8"))
+SCRAPE_PER_HOST = int(os.environ.get("HANNA_SCRAPE_PER_HOST", "2"))
 
+def fetch_page(url, headers, host_limit):
+    """
+    Fetch and parse one page. Returns (title, text), or None on error.
+    host_limit is the semaphore bounding concurrent requests to url's host.
+    """
+    try:
+        with host_limit:
+            response = SESSION.get(url, timeout=10, headers=headers)
+        response.raise_for_status()
+        soup = BeautifulSoup(response.text, HTML_PARSER)
+        text = soup.get_text(separator=" ", strip=True)
+        title = soup.title.string.strip() if soup.title and soup.title.string else url
+        return title, text
+    except Exception as e:
+        print(f"Error scraping {url}: {e}")
+        return None
 
 def scrape_and_send_to_n8n(urls, webhook_url, ca_cert_path=None, excluded_domains_path=None):
     """
@@ -55,7 +69,7 @@ def scrape_and_send_to_n8n(urls, webhook_url, ca_cert_path=None, excluded_domain
         ca_cert_path (str): Path to CA certificate for SSL verification.
         excluded_domains_path (str): Path to exclusions list (JSON).
     """
-    excluded_domains = load_excluded_domains_json(excluded_domains_path) if excluded_domains_path else set()
+    excluded_domains = load_excluded_domains_json(excluded_domains_path) if excluded_domains_path else frozenset()
     tags = input("Tags for this batch (comma-separated, optional): ").strip()
     tag_list = [t.strip() for t in tags.split(",") if t.strip()] if tags else []
     source_type = "web"
@@ -64,23 +78,44 @@ def scrape_and_send_to_n8n(urls, webhook_url, ca_cert_path=None, excluded_domain
     related_list = [t.strip() for t in related_entities.split(",") if t.strip()] if related_entities else []
     user_agent = "HannaWebScraper/1.0 (+https://botinfo.hivenet.dev/)"
     headers = {"User-Agent": user_agent}
+    to_fetch = []
+    host_limits = {}
     for url in urls:
-        domain = urlparse(url).netloc.lower()
-        if any(domain == ex or domain.endswith('.' + ex) for ex in excluded_domains):
+        try:
+            domain = (urlsplit(url).hostname or url).lower()
+        except ValueError as e:
+            print(f"Skipping invalid URL {url}: {e}")
+            continue
+        if is_excluded(domain, excluded_domains):
             print(f"Skipping excluded domain: {domain}")
             continue
-        try:
-            print(f"Scraping: {url}")
-            response = requests.get(url, timeout=10, headers=headers)
-            response.raise_for_status()
-            soup = BeautifulSoup(response.text, "html.parser")
-            text = soup.get_text(separator=" ", strip=True)
-            title = soup.title.string.strip() if soup.title and soup.title.string else url
-            print(f"Scraped text (first 500 chars):\n{text[:500]}\n---")
+        if domain not in host_limits:
+            host_limits[domain] = threading.BoundedSemaphore(SCRAPE_PER_HOST)
+        to_fetch.append((url, host_limits[domain]))
+    facts = []
+    now_iso = datetime.now(timezone.utc).isoformat(timespec='seconds').replace('+00:00', 'Z')
+    with ThreadPoolExecutor(max_workers=SCRAPE_WORKERS) as executor:
+        print(f"Scraping {len(to_fetch)} URLs...")
+        pages = executor.map(lambda job: fetch_page(job[0], headers, job[1]), to_fetch)
+        for (url, _), page in zip(to_fetch, pages):
+            if page is None:
+                continue
+            title, text = page
+            print(f"Scraped {url} (first 500 chars):\n{text[:500]}\n---")
             fact_id = str(uuid.uuid4())
+            payload = {
+                "id": fact_id,
+                "text": text,
+                "url": url,
+                "title": title,
+                "source_type": source_type,
+                "confidence": confidence,
+                "timestamp": now_iso,
+                "sourceUser": None,
+                "tags": tag_list,
+                "related_entities": related_list
+            }
             facts.append(payload)
-        except Exception as e:
-            print(f"Error scraping {url}: {e}")
     if not facts:
         print("No facts to send. Exiting.")
         return
@@ -88,7 +123,7 @@ def scrape_and_send_to_n8n(urls, webhook_url, ca_cert_path=None, excluded_domain
         verify = ca_cert_path if ca_cert_path else True
         for i, fact in enumerate(facts, 1):
             print(f"\nSending fact {i}/{len(facts)} to n8n webhook: {webhook_url}")
-            r = requests.post(webhook_url, json=fact, timeout=10, verify=verify)
+            r = SESSION.post(webhook_url, data=dump_json(fact), headers=JSON_HEADERS, timeout=10, verify=verify)
             print(f"Status: {r.status_code}")
             print(f"Response: {r.text}")
     except Exception as e: